@@ -1,73 +1,422 @@
+import click
+import numpy as np
+import orjson
 import requests
-import statistics
+from requests.adapters import HTTPAdapter
 import os
-import json
 from glob import glob
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+POOL_MAXSIZE = 16
+REQUEST_TIMEOUT = 60
+
+# Share one keep-alive connection pool across all iterations so the measured
+# round trip reflects server work rather than TCP connection setup
+SESSION = requests.Session()
+SESSION.mount(
+    "http://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=0),
+)
+
+
+# Where each server-side timing is found in a /process_gpx response. The
+# round_trip metric is measured by the client and is always available.
+METRIC_PATHS = {
+    "server_processing": ("processing_times_ms", "total"),
+    "gpx_parsing": ("processing_times_ms", "gpx_parsing"),
+    "linestring_conversion": ("processing_times_ms", "linestring_conversion"),
+    "intersection_finding": ("processing_times_ms", "intersection_finding"),
+}
+METRICS = ["round_trip", *METRIC_PATHS]
+
+
+def summarize(timings):
+    """Summarize timings with vectorized NumPy reductions."""
+    samples = np.asarray(timings, dtype=np.float64)
+    return {
+        "min_ms": float(samples.min()),
+        "max_ms": float(samples.max()),
+        "avg_ms": float(samples.mean()),
+        "median_ms": float(np.median(samples)),
+    }
+
+
+EMPTY_SUMMARY = {"min_ms": 0, "max_ms": 0, "avg_ms": 0, "median_ms": 0}
+
+
+def deep_get(data, path):
+    """Follow a tuple of keys into nested dicts, returning None if missing."""
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def prepare_upload(url, files, use_cache=False):
+    """Build the multipart upload once so iterations only have to send it.
+
+    Unless use_cache is set, the server is asked to skip its response cache,
+    otherwise every iteration after the first would only time a cache hit.
+    """
+    params = {} if use_cache else {"no_cache": "true"}
+    return SESSION.prepare_request(
+        requests.Request("POST", url, params=params, files=files)
+    )
+
+
+def run_iteration(prepared, metrics=METRICS):
+    """Send a prepared upload once.
+
+    Returns (status code, crossings, {metric: ms}) where server metrics missing
+    from the response are left out.
+    """
+    # perf_counter is monotonic and high resolution, unlike the wall clock
+    start_ns = time.perf_counter_ns()
+    response = SESSION.send(prepared, timeout=REQUEST_TIMEOUT)
+    round_trip_time = (time.perf_counter_ns() - start_ns) / 1e6
+
+    timings = {"round_trip": round_trip_time} if "round_trip" in metrics else {}
+    if response.status_code != 200:
+        return response.status_code, None, timings
+
+    data = orjson.loads(response.content)
+    for metric in metrics:
+        if metric in METRIC_PATHS:
+            value = deep_get(data, METRIC_PATHS[metric])
+            if value is not None:
+                timings[metric] = value
+    return response.status_code, len(data.get("crossings", [])), timings
+
+
+def format_run(i, sample):
+    """Format one benchmark sample for the console."""
+    status_code, crossing_count, timings = sample
+    if crossing_count is None:
+        return f"  Run {i + 1}: Error - {status_code}"
+    details = ", ".join(
+        f"{metric.replace('_', ' ').capitalize()}: {value:.2f}ms"
+        for metric, value in timings.items()
+    )
+    return f"  Run {i + 1}: Crossings: {crossing_count}, {details}"
+
+
+def bench_one(
+    api_url,
+    gpx_file,
+    iterations=5,
+    concurrency=1,
+    warmup_iterations=1,
+    metrics=METRICS,
+    use_cache=False,
+):
+    """Benchmark a single GPX file.
+
+    Returns (file name, result or None, {metric: timings in ms}).
+    """
+    name = os.path.basename(gpx_file)
+    print(f"Benchmarking {name}...")
+
+    # Initialize metrics collection
+    crossing_counts = []
+    timings = {metric: [] for metric in metrics}
+
+    # Read the file once and reuse the same payload for every iteration
+    with open(gpx_file, "rb") as f:
+        payload = f.read()
+    files = {"file": (name, payload, "application/gpx+xml")}
+
+    prepared = prepare_upload(f"{api_url}/process_gpx", files, use_cache)
+
+    # Warm up the connection and server caches; these samples are discarded
+    for _ in range(warmup_iterations):
+        run_iteration(prepared, metrics)
+
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(
+                executor.map(
+                    lambda _: run_iteration(prepared, metrics), range(iterations)
+                )
+            )
+    else:
+        samples = [run_iteration(prepared, metrics) for _ in range(iterations)]
+
+    # Print once after the timed loop so console I/O doesn't skew the samples
+    print("\n".join(format_run(i, sample) for i, sample in enumerate(samples)))
+
+    for _, crossing_count, sample_timings in samples:
+        if crossing_count is not None:
+            crossing_counts.append(crossing_count)
+            for metric, value in sample_timings.items():
+                timings[metric].append(value)
+
+    if not crossing_counts:
+        return name, None, timings
+
+    file_result = {"crossing_count": crossing_counts[0]}  # Same for all runs
+    for metric, values in timings.items():
+        if values:
+            file_result[metric] = summarize(values)
+    return name, file_result, timings
+
+
+def batch_supported(api_url):
+    """Check whether the server exposes the /process_gpx_batch endpoint."""
+    # A POST-only route answers OPTIONS with 405, a missing one with 404
+    return SESSION.options(f"{api_url}/process_gpx_batch").status_code != 404
+
+
+def bench_batch(
+    api_url,
+    gpx_files,
+    iterations=5,
+    warmup_iterations=1,
+    metrics=METRICS,
+    use_cache=False,
+):
+    """Benchmark all GPX files together, one batch request per iteration.
+
+    Server metrics are taken from each file's entry in the batch response,
+    round trips can only be timed for the batch as a whole.
+
+    Returns (file name, result, {metric: timings in ms}) per file and the round
+    trip timings in ms of the whole batch.
+    """
+    print(f"Benchmarking {len(gpx_files)} files as one batch...")
+
+    files = []
+    for gpx_file in gpx_files:
+        with open(gpx_file, "rb") as f:
+            payload = f.read()
+        name = os.path.basename(gpx_file)
+        files.append(("files", (name, payload, "application/gpx+xml")))
+
+    prepared = prepare_upload(f"{api_url}/process_gpx_batch", files, use_cache)
+    for _ in range(warmup_iterations):
+        SESSION.send(prepared, timeout=REQUEST_TIMEOUT)
+
+    runs = []
+    for _ in range(iterations):
+        start_ns = time.perf_counter_ns()
+        response = SESSION.send(prepared, timeout=REQUEST_TIMEOUT)
+        round_trip_time = (time.perf_counter_ns() - start_ns) / 1e6
+        runs.append((response, round_trip_time))
+
+    crossing_counts = {}
+    file_timings = {}
+    round_trips = []
+    lines = []
+    for i, (response, round_trip_time) in enumerate(runs):
+        if response.status_code != 200:
+            lines.append(f"  Run {i + 1}: Error - {response.status_code}")
+            continue
+
+        round_trips.append(round_trip_time)
+        lines.append(f"  Run {i + 1}: Round trip: {round_trip_time:.2f}ms")
+        for data in orjson.loads(response.content)["results"]:
+            name = data["filename"]
+            crossing_counts.setdefault(name, len(data.get("crossings", [])))
+            timings = file_timings.setdefault(
+                name, {metric: [] for metric in metrics if metric in METRIC_PATHS}
+            )
+            for metric, values in timings.items():
+                value = deep_get(data, METRIC_PATHS[metric])
+                if value is not None:
+                    values.append(value)
+    print("\n".join(lines))
+
+    file_results = []
+    for name, crossing_count in crossing_counts.items():
+        file_result = {"crossing_count": crossing_count}  # Same for all runs
+        for metric, values in file_timings[name].items():
+            if values:
+                file_result[metric] = summarize(values)
+        file_results.append((name, file_result, file_timings[name]))
+    return file_results, round_trips
 
 
 def benchmark_gpx_processing(
-    api_url, gpx_files, iterations=5, log_dir="benchmark_logs"
+    api_url,
+    gpx_files,
+    iterations=5,
+    log_dir="benchmark_logs",
+    concurrency=1,
+    parallel_files=False,
+    warmup_iterations=1,
+    batch=False,
+    metrics=METRICS,
+    use_cache=False,
 ):
-    """Benchmark GPX processing performance and log results."""
+    """Benchmark GPX processing performance and log results.
+
+    With concurrency > 1 the iterations for each file are sent in parallel,
+    and with parallel_files the files themselves are benchmarked side by side.
+    Both measure throughput rather than single-request latency. The first
+    warmup_iterations requests per file are not included in the results.
+
+    With batch, all files are sent in a single request per iteration if the
+    server supports it. Round trips are then timed per batch, not per file.
+
+    metrics selects which of METRICS are recorded; server-side metrics are
+    only available if the server reports processing_times_ms.
+
+    The server's response cache is bypassed unless use_cache is set.
+    """
+
+    if batch:
+        if batch_supported(api_url):
+            return benchmark_gpx_batch(
+                api_url,
+                gpx_files,
+                iterations,
+                log_dir,
+                warmup_iterations,
+                metrics,
+                use_cache,
+            )
+        print("Server has no batch endpoint, benchmarking files one by one.")
+
+    file_workers = min(8, len(gpx_files)) if parallel_files else 1
+    connections = concurrency * file_workers
+    if connections > POOL_MAXSIZE:
+        SESSION.mount(
+            "http://",
+            HTTPAdapter(pool_connections=1, pool_maxsize=connections, max_retries=0),
+        )
 
     os.makedirs(log_dir, exist_ok=True)
     log_file = os.path.join(log_dir, f"benchmark_{int(time.time())}.json")
 
     results = {}
 
-    for gpx_file in gpx_files:
-        print(f"Benchmarking {os.path.basename(gpx_file)}...")
-
-        # Initialize metrics collection
-        crossing_counts = []
-        timings = []
-
-        for i in range(iterations):
-            with open(gpx_file, "rb") as f:
-                start_time = time.time()
-                response = requests.post(f"{api_url}/process_gpx", files={"file": f})
-                end_time = time.time()
-
-                round_trip_time = (
-                    end_time - start_time
-                ) * 1000  # Convert to milliseconds
-
-                if response.status_code == 200:
-                    data = response.json()
-                    crossing_counts.append(len(data.get("crossings", [])))
-                    timings.append(round_trip_time)
-
-                    print(
-                        f"  Run {i + 1}: Crossings: {len(data.get('crossings', []))}, Round trip: {round_trip_time:.2f}ms"
-                    )
-                else:
-                    print(f"  Run {i + 1}: Error - {response.status_code}")
-
-        if crossing_counts:
-            # Store results for this file
-            file_result = {
-                "crossing_count": crossing_counts[0],  # Should be same for all runs
-                "timings_ms": {
-                    "min": min(timings),
-                    "max": max(timings),
-                    "avg": sum(timings) / len(timings),
-                    "median": statistics.median(timings),
-                },
-            }
-
-            results[os.path.basename(gpx_file)] = file_result
-
-    # Save results to log file
-    with open(log_file, "w") as f:
-        json.dump(results, f, indent=2)
+    def run(gpx_file):
+        return bench_one(
+            api_url,
+            gpx_file,
+            iterations,
+            concurrency,
+            warmup_iterations,
+            metrics,
+            use_cache,
+        )
 
-    print(f"\nBenchmark results saved to {log_file}")
+    if file_workers > 1:
+        with ThreadPoolExecutor(max_workers=file_workers) as executor:
+            file_results = list(executor.map(run, gpx_files))
+    else:
+        file_results = [run(gpx_file) for gpx_file in gpx_files]
+
+    metrics_data = {metric: [] for metric in metrics}
+    total_crossings = 0
+    for name, file_result, timings in file_results:
+        if file_result is not None:
+            results[name] = file_result
+            total_crossings += file_result["crossing_count"]
+            for metric, values in timings.items():
+                metrics_data[metric].extend(values)
+
+    aggregate = {"total_files": len(results), "total_crossings": total_crossings}
+    for key, timings in metrics_data.items():
+        # Skip server metrics the server didn't report
+        if timings or key == "round_trip":
+            aggregate[key] = summarize(timings) if timings else EMPTY_SUMMARY
+    results["_aggregate"] = aggregate
+
+    save_results(results, log_file)
+    if warmup_iterations:
+        print(f"Timings exclude {warmup_iterations} warmup request(s) per file.")
     return results
 
 
-if __name__ == "__main__":
-    api_url = "http://localhost:8000"
+def benchmark_gpx_batch(
+    api_url,
+    gpx_files,
+    iterations=5,
+    log_dir="benchmark_logs",
+    warmup_iterations=1,
+    metrics=METRICS,
+    use_cache=False,
+):
+    """Benchmark GPX processing via the batch endpoint and log results."""
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, f"benchmark_batch_{int(time.time())}.json")
+
+    file_results, round_trips = bench_batch(
+        api_url, gpx_files, iterations, warmup_iterations, metrics, use_cache
+    )
+
+    results = {}
+    metrics_data = {metric: [] for metric in metrics if metric in METRIC_PATHS}
+    total_crossings = 0
+    for name, file_result, timings in file_results:
+        results[name] = file_result
+        total_crossings += file_result["crossing_count"]
+        for metric, values in timings.items():
+            metrics_data[metric].extend(values)
+
+    aggregate = {"total_files": len(results), "total_crossings": total_crossings}
+    for key, timings in metrics_data.items():
+        # Skip server metrics the server didn't report
+        if timings:
+            aggregate[key] = summarize(timings)
+    aggregate["batch_round_trip"] = (
+        summarize(round_trips) if round_trips else EMPTY_SUMMARY
+    )
+    results["_aggregate"] = aggregate
+
+    save_results(results, log_file)
+    if warmup_iterations:
+        print(f"Timings exclude {warmup_iterations} warmup batch request(s).")
+    return results
+
+
+def save_results(results, log_file):
+    """Save benchmark results to a JSON log file."""
+    with open(log_file, "wb") as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+
+    print(f"\nBenchmark results saved to {log_file}")
+
+
+@click.command()
+@click.option("--api-url", default="http://localhost:8000", help="Server base URL.")
+@click.option("--iterations", default=5, help="Requests per GPX file.")
+@click.option(
+    "--concurrency", default=1, help="Parallel requests per GPX file (1 = serial)."
+)
+@click.option(
+    "--parallel-files",
+    is_flag=True,
+    help="Benchmark all GPX files concurrently instead of one after another.",
+)
+@click.option(
+    "--warmup", default=1, help="Untimed requests per GPX file before measuring."
+)
+@click.option(
+    "--batch",
+    is_flag=True,
+    help="Send all GPX files in one request per iteration if the server allows.",
+)
+@click.option(
+    "--metric",
+    "metrics",
+    type=click.Choice(METRICS),
+    multiple=True,
+    default=METRICS,
+    show_default=True,
+    help="Timing to record (repeat for several).",
+)
+@click.option(
+    "--use-cache",
+    is_flag=True,
+    help="Let the server answer repeated uploads from its response cache.",
+)
+def main(
+    api_url, iterations, concurrency, parallel_files, warmup, batch, metrics, use_cache
+):
+    """Benchmark the /process_gpx endpoint with the bundled test tracks."""
     gpx_files = glob("test_data/gpx/*.gpx")
 
     if not gpx_files:
@@ -75,4 +424,18 @@ if __name__ == "__main__":
     else:
         print(f"Found {len(gpx_files)} GPX files to benchmark.")
         print(f"Files: {', '.join([os.path.basename(f) for f in gpx_files])}")
-        benchmark_gpx_processing(api_url, gpx_files)
+        benchmark_gpx_processing(
+            api_url,
+            gpx_files,
+            iterations=iterations,
+            concurrency=concurrency,
+            parallel_files=parallel_files,
+            warmup_iterations=warmup,
+            batch=batch,
+            metrics=list(metrics),
+            use_cache=use_cache,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,14 @@
+import hashlib
+import json
 import os
+import re
+import selectors
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cache
+from pathlib import Path
+import requests
 from tqdm import tqdm
 from enum import Enum
 import click
@@ -32,55 +41,200 @@ class Country(Enum):
     UNITED_KINGDOM = "great-britain"
 
 
+# All paths are resolved against the repository root, not the working directory
+ROOT_DIR = Path(__file__).resolve().parent
+DATA_DIR = ROOT_DIR / "data"
+RAW_DIR = DATA_DIR / "raw"
+FILTERED_DIR = DATA_DIR / "filtered"
+PARQUET_DIR = DATA_DIR / "parquet"
+DB_PATH = DATA_DIR / "pond.duckdb"
+QUELLE_DIR = ROOT_DIR / "quelle"
+OHSOME_PLANET_JAR = (
+    ROOT_DIR / "ohsome-planet" / "ohsome-planet-cli" / "target" / "ohsome-planet.jar"
+)
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# One session for all downloads, so countries prepared in the same run reuse
+# the keep-alive TLS connection to Geofabrik instead of a new handshake each
+SESSION = requests.Session()
+
+# Serializes overwrite prompts when several countries are prepared at once
+PROMPT_LOCK = threading.Lock()
+
+# Minimum seconds between progress bar redraws
+PROGRESS_INTERVAL = 0.1
+
+# Matches the percentage in osmium's --progress output, e.g. "[====>   ] 42%"
+OSMIUM_PROGRESS_RE = re.compile(r"(\d+)%")
+
+# Matches dbt's per-node status lines, e.g. "12:00:00  3 of 7 OK created ..."
+DBT_PROGRESS_RE = re.compile(r"\b(\d+) of (\d+) (START|OK|PASS|WARN|ERROR|FAIL|SKIP)\b")
+
+
+# Geofabrik download URL of the latest extract for every supported country
+GEOFABRIK_URLS = {
+    c: "https://download.geofabrik.de/europe-latest.osm.pbf"
+    if c is Country.EUROPE
+    else f"https://download.geofabrik.de/europe/{c.value}-latest.osm.pbf"
+    for c in Country
+}
+
+
 @click.command()
 @click.option(
     "--country",
+    "countries",
     type=click.Choice([c.name for c in Country], case_sensitive=False),
-    help="Country which to process OSM data 🌍",
+    help="Country which to process OSM data 🌍 (repeat for several countries)",
     required=True,
+    multiple=True,
 )
 @click.option(
     "--skip-dbt", is_flag=True, help="Skip running the dbt after data preparation."
 )
-def main(country, skip_dbt):
-    """Prepare waterway data for the specified country."""
-    print(f"🚀 Starting waterway data preparation for {country}...")
-    country_enum = Country[country.upper()]
-
-    osm_file = download_osm_file(country_enum)
-    if not osm_file:
-        print("🛑 Halting process as OSM file step was skipped or failed.")
+@click.option(
+    "--keep-raw",
+    is_flag=True,
+    help="Keep the unfiltered OSM file on disk instead of streaming it into osmium.",
+)
+@click.option(
+    "--workers",
+    default=2,
+    show_default=True,
+    help="Countries processed at the same time per stage when preparing several.",
+)
+def main(countries, skip_dbt, keep_raw, workers):
+    """Prepare waterway data for the specified countries."""
+    country_enums = [Country[country.upper()] for country in countries]
+
+    if len(country_enums) == 1:
+        prepared = prepare_country(country_enums[0], keep_raw)
+    else:
+        prepared = prepare_countries(country_enums, keep_raw, workers)
+    if not prepared:
         return
 
-    filtered_file = filter_waterways(country_enum, osm_file)
+    if not skip_dbt:
+        run_dbt(country_enums)
+
+
+def prepare_country(country: Country, keep_raw=False):
+    """Download, filter and convert the waterways of a single country."""
+    filtered_file = fetch_waterways(country, keep_raw)
+    if not filtered_file:
+        return None
+
+    return convert_waterways(country, filtered_file)
+
+
+def prepare_countries(countries: list[Country], keep_raw=False, workers=2):
+    """Download, filter and convert the waterways of several countries.
+
+    Fetching (download + osmium) and conversion (Java) each run in their own
+    thread pool, so one country is converted while the next is still being
+    downloaded. The work happens in subprocesses, so the GIL is not a limit.
+    """
+    with (
+        ThreadPoolExecutor(max_workers=workers) as fetch_pool,
+        ThreadPoolExecutor(max_workers=workers) as convert_pool,
+    ):
+        fetch_futures = {
+            fetch_pool.submit(fetch_waterways, country, keep_raw): country
+            for country in countries
+        }
+        convert_futures = []
+        try:
+            for future in as_completed(fetch_futures):
+                filtered_file = future.result()
+                if not filtered_file:
+                    return None
+                country = fetch_futures[future]
+                convert_futures.append(
+                    convert_pool.submit(convert_waterways, country, filtered_file)
+                )
+
+            geoparquet_dirs = [future.result() for future in convert_futures]
+        finally:
+            # When a country fails, queued countries are dropped rather than
+            # downloaded and converted before the error shows up
+            fetch_pool.shutdown(cancel_futures=True)
+            convert_pool.shutdown(cancel_futures=True)
+
+    return geoparquet_dirs if all(geoparquet_dirs) else None
+
+
+def fetch_waterways(country: Country, keep_raw=False):
+    """Download the OSM extract of a country and filter it for waterways."""
+    print(f"🚀 Starting waterway data preparation for {country.name}...")
+
+    if keep_raw:
+        osm_file = download_osm_file(country)
+        if not osm_file:
+            print("🛑 Halting process as OSM file step was skipped or failed.")
+            return None
+        if not validate_osm_file(osm_file):
+            print(f"❌ {osm_file} is not a valid OSM file. Delete it and run again.")
+            return None
+
+        filtered_file = filter_waterways(country, osm_file)
+    else:
+        filtered_file = download_and_filter_waterways(country)
     if not filtered_file:
         print("🛑 Halting process as filtering step was skipped or failed.")
-        return
+        return None
+    if not check_filtered_file(filtered_file):
+        print(f"❌ Filtered file {filtered_file} is not a valid OSM file.")
+        return None
+
+    return filtered_file
+
 
-    geoparquet_dir = convert_to_geoparquet(country_enum, filtered_file)
+def convert_waterways(country: Country, filtered_file):
+    """Convert the filtered waterways of a country to GeoParquet."""
+    geoparquet_dir = convert_to_geoparquet(country, filtered_file)
     if not geoparquet_dir:
         print("🛑 Halting process as GeoParquet conversion was skipped or failed.")
-        return
+        return None
 
     print(f"🎉 GeoParquet files are ready in {geoparquet_dir}.")
+    return geoparquet_dir
+
+
+@cache
+def ensure_dir(path: Path):
+    """Create a directory once per run, later calls don't touch the disk."""
+    path.mkdir(parents=True, exist_ok=True)
+    return path
 
-    if not skip_dbt:
-        run_dbt(country_enum)
 
+def sidecar(path: Path, suffix):
+    """Path of a file stored next to path, e.g. <file>.part."""
+    return path.with_name(path.name + suffix)
 
-def download_osm_file(country: Country, output_dir="data/raw"):
+
+def confirm(message):
+    """Ask the user for confirmation, one prompt at a time across threads."""
+    with PROMPT_LOCK:
+        return click.confirm(message, default=False)
+
+
+def download_osm_file(country: Country, output_dir=RAW_DIR):
     """Download the latest OSM file for a given country from Geofabrik."""
     # Create country-specific subdirectory
-    country_dir = os.path.join(output_dir, country.value)
-    os.makedirs(country_dir, exist_ok=True)
-
-    osm_file = os.path.join(country_dir, f"{country.value}-latest.osm.pbf")
+    country_dir = ensure_dir(Path(output_dir) / country.value)
+    osm_file = country_dir / f"{country.value}-latest.osm.pbf"
 
-    if os.path.exists(osm_file):
-        if not click.confirm(
-            f"⚠️ {osm_file} already exists. Do you want to overwrite it?",
-            default=False,
-        ):
+    if osm_file.exists():
+        if is_not_modified(osm_file, GEOFABRIK_URLS[country]):
+            print(f"✅ {osm_file} is cached and up to date. Skipping download.")
+            return osm_file
+        if is_up_to_date(osm_file, GEOFABRIK_URLS[country]):
+            print(
+                f"✅ {osm_file} matches the latest Geofabrik extract. Skipping download."
+            )
+            return osm_file
+        if not confirm(f"⚠️ {osm_file} already exists. Do you want to overwrite it?"):
             print(f"✅ {osm_file} already exists. Skipping download.")
             return osm_file
         else:
@@ -89,43 +243,205 @@ def download_osm_file(country: Country, output_dir="data/raw"):
             )
 
     print(f"🌍 Downloading {country.name} OSM file...")
+    download_file(GEOFABRIK_URLS[country], osm_file)
+
+    print("✅ Download complete.")
     return osm_file
 
 
-def validate_osm_file(osm_file):
-    """Validate the OSM file using osmium."""
+def remote_md5(url):
+    """Fetch the MD5 checksum Geofabrik publishes next to each extract."""
+    response = SESSION.get(f"{url}.md5", timeout=30)
+    response.raise_for_status()
+    return response.text.split()[0]
+
+
+def local_md5(path):
+    """Compute the MD5 checksum of a local file."""
+    md5 = hashlib.md5()
+    with open(path, "rb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def is_not_modified(path, url):
+    """Ask the server whether a download changed since it was stored.
+
+    Sends the ETag and Last-Modified saved next to the file as a conditional
+    GET, so an unchanged extract costs a single 304 response.
+    """
+    validators = load_validators(path)
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    if not headers:
+        return False
+
     try:
-        subprocess.run(
-            ["osmium", "fileinfo", osm_file], check=True, stdout=subprocess.DEVNULL
-        )
-        return True
-    except subprocess.CalledProcessError:
+        with SESSION.get(url, headers=headers, stream=True, timeout=30) as response:
+            return response.status_code == 304
+    except requests.RequestException as e:
+        print(f"⚠️ Could not check {url} for changes: {e}")
+        return False
+
+
+def load_validators(path):
+    """Read the cache validators stored next to a download, if there are any."""
+    try:
+        with open(sidecar(path, ".http.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_validators(path, response):
+    """Store the cache validators of a download next to it."""
+    validators = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    with open(sidecar(path, ".http.json"), "w") as f:
+        json.dump(validators, f)
+
+
+def is_up_to_date(path, url):
+    """Check if a local file matches the remote extract by its checksum."""
+    try:
+        checksum = remote_md5(url)
+    except requests.RequestException as e:
+        print(f"⚠️ Could not fetch checksum for {url}: {e}")
         return False
+    return local_md5(path) == checksum
+
+
+def download_file(url, path):
+    """Download a URL to path, resuming an interrupted download if possible.
+
+    Data is written to a ``.part`` file next to the target which is only moved
+    into place once complete, so a broken transfer can continue from where it
+    stopped on the next run. The remote file's validators are stored next to
+    the ``.part`` file, and a resumed request sends them as If-Range so that
+    bytes of a newer extract are never appended to an older one.
+    """
+    path = Path(path)
+    part_file = sidecar(path, ".part")
+    existing = part_file.stat().st_size if part_file.exists() else 0
+    headers = {}
+    if existing:
+        # If-Range needs a strong ETag, otherwise the date is used
+        validators = load_validators(part_file)
+        etag = validators.get("etag")
+        if_range = etag if etag and not etag.startswith("W/") else None
+        if_range = if_range or validators.get("last_modified")
+        if if_range:
+            headers = {"Range": f"bytes={existing}-", "If-Range": if_range}
+        else:
+            print("ℹ️ Partial download can't be matched to the remote file.")
+            existing = 0
+
+    with SESSION.get(url, stream=True, headers=headers, timeout=60) as response:
+        if response.status_code == 416:
+            # The partial file doesn't match the remote file anymore
+            print("ℹ️ Partial download is out of date. Restarting download.")
+            part_file.unlink()
+            return download_file(url, path)
+        response.raise_for_status()
+
+        if existing and response.status_code != 206:
+            # The remote file changed since the partial download was started,
+            # or the server can't send ranges, either way it sent all of it
+            print("ℹ️ Partial download can't be resumed. Restarting download.")
+            existing = 0
+        elif existing:
+            print(f"ℹ️ Resuming download after {existing} bytes.")
+        if not existing:
+            save_validators(part_file, response)
+
+        content_length = response.headers.get("Content-Length")
+        expected_size = existing + int(content_length) if content_length else None
+
+        with (
+            open(part_file, "ab" if existing else "wb") as out,
+            progress_bar(
+                total=expected_size,
+                initial=existing,
+                desc="Downloading",
+                unit="B",
+                unit_scale=True,
+            ) as pbar,
+        ):
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                out.write(chunk)
+                pbar.update(len(chunk))
+
+    if expected_size is not None and part_file.stat().st_size != expected_size:
+        raise IOError(
+            f"❌ Download of {url} is incomplete. Run again to resume the download."
+        )
+
+    part_file.replace(path)
+    save_validators(path, response)
+    sidecar(part_file, ".http.json").unlink(missing_ok=True)
+    return path
+
+
+def validate_osm_file(osm_file):
+    """Validate the OSM file using osmium."""
+    return osmium_fileinfo_ok(osm_file)
 
 
 def check_filtered_file(filtered_file):
     """Check if the filtered OSM file is valid."""
+    return osmium_fileinfo_ok(filtered_file)
+
+
+def file_fingerprint(path):
+    """Identify a file's contents by its mtime, size and first megabyte."""
+    stat = Path(path).stat()
+    with open(path, "rb") as f:
+        head = hashlib.sha256(f.read(1 << 20)).hexdigest()
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "head_sha256": head}
+
+
+def osmium_fileinfo_ok(path):
+    """Check a PBF file with osmium fileinfo, remembering files that passed.
+
+    A successful check is recorded in a <file>.valid.json sidecar, so an
+    unchanged file isn't scanned by osmium again on the next run.
+    """
+    memo_file = sidecar(Path(path), ".valid.json")
+    fingerprint = file_fingerprint(path)
+    try:
+        with open(memo_file) as f:
+            if json.load(f) == fingerprint:
+                return True
+    except (OSError, ValueError):
+        pass
+
     try:
         subprocess.run(
-            ["osmium", "fileinfo", filtered_file], check=True, stdout=subprocess.DEVNULL
+            ["osmium", "fileinfo", path], check=True, stdout=subprocess.DEVNULL
         )
-        return True
     except subprocess.CalledProcessError:
         return False
 
+    with open(memo_file, "w") as f:
+        json.dump(fingerprint, f)
+    return True
+
 
-def filter_waterways(country: Country, osm_file, output_dir="data/filtered"):
+def filter_waterways(country: Country, osm_file, output_dir=FILTERED_DIR):
     """Filter the OSM file for waterways and relations using osmium."""
     # Create country-specific subdirectory
-    country_dir = os.path.join(output_dir, country.value)
-    os.makedirs(country_dir, exist_ok=True)
+    country_dir = ensure_dir(Path(output_dir) / country.value)
+    filtered_file = country_dir / f"{country.value}-waterways.osm.pbf"
 
-    filtered_file = os.path.join(country_dir, f"{country.value}-waterways.osm.pbf")
-
-    if os.path.exists(filtered_file):
-        if not click.confirm(
-            f"⚠️ Filtered file {filtered_file} already exists. Do you want to overwrite it?",
-            default=False,
+    if filtered_file.exists():
+        if not confirm(
+            f"⚠️ Filtered file {filtered_file} already exists. Do you want to overwrite it?"
         ):
             print(
                 f"✅ Filtered file {filtered_file} already exists. Skipping filtering."
@@ -137,7 +453,7 @@ def filter_waterways(country: Country, osm_file, output_dir="data/filtered"):
             )
 
     print(f"🚰 Filtering waterways and relations from {country.name} OSM file...")
-    with tqdm(total=100, desc="Filtering", unit="%") as pbar:
+    with progress_bar(total=100, desc="Filtering", unit="%") as pbar:
         process = subprocess.Popen(
             [
                 "osmium",
@@ -149,46 +465,155 @@ def filter_waterways(country: Country, osm_file, output_dir="data/filtered"):
                 filtered_file,
                 "--overwrite",
                 "--verbose",
+                "--progress",
             ],
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
         )
 
-        if process.stdout:
-            for line in process.stdout:
-                print(line.strip())
-                pbar.update(1)
-        else:
-            print("Warning: No stdout from osmium process")
+        def on_line(line):
+            match = OSMIUM_PROGRESS_RE.search(line)
+            if not match:
+                if line.strip():
+                    pbar.write(line.strip())
+                return
 
+            # osmium redraws its progress bar far more often than is useful,
+            # the bar itself only redraws every PROGRESS_INTERVAL
+            percent = int(match.group(1))
+            if percent > pbar.n:
+                pbar.update(percent - pbar.n)
+
+        stream_output(process, on_line)
         process.wait()
 
         if process.returncode != 0:
             raise subprocess.CalledProcessError(process.returncode, process.args)
 
-    print("✅ Filtering complete and file is valid.")
+    print("✅ Filtering complete.")
     return filtered_file
 
 
-def convert_to_geoparquet(country: Country, filtered_file, output_dir="data/parquet"):
-    """Convert the filtered OSM file to GeoParquet using ohsome-planet."""
+def progress_bar(**kwargs):
+    """Create a tqdm bar that redraws at most every PROGRESS_INTERVAL.
+
+    Bars are disabled when stderr isn't a terminal, e.g. in CI logs, where
+    every redraw would otherwise end up as a line of output.
+    """
+    return tqdm(mininterval=PROGRESS_INTERVAL, disable=None, **kwargs)
+
+
+def stream_output(process, on_line):
+    """Drain a subprocess' stdout as it arrives and call on_line for each line.
+
+    The pipe is polled with a selector and read in large chunks, so a chatty
+    process never blocks on a full pipe. Carriage returns count as line breaks
+    so progress bars that redraw in place are reported on every redraw.
+    """
+    fd = process.stdout.fileno()
+    buffer = b""
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while True:
+            if not selector.select(timeout=PROGRESS_INTERVAL):
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            *lines, buffer = re.split(rb"[\r\n]", buffer + chunk)
+            for line in lines:
+                on_line(line.decode(errors="replace"))
+    if buffer:
+        on_line(buffer.decode(errors="replace"))
+    process.stdout.close()
+
+
+def download_and_filter_waterways(country: Country, output_dir=FILTERED_DIR):
+    """Stream the OSM download straight into osmium's waterway filter.
+
+    This avoids writing the unfiltered country extract to disk and reading it
+    back, which is the bulk of the I/O for large countries.
+    """
     # Create country-specific subdirectory
-    country_dir = os.path.join(output_dir, country.value)
-    os.makedirs(country_dir, exist_ok=True)
+    country_dir = ensure_dir(Path(output_dir) / country.value)
+    filtered_file = country_dir / f"{country.value}-waterways.osm.pbf"
 
-    geoparquet_dir = country_dir
-    jar_path = "ohsome-planet/ohsome-planet-cli/target/ohsome-planet.jar"
+    if filtered_file.exists():
+        if not confirm(
+            f"⚠️ Filtered file {filtered_file} already exists. Do you want to overwrite it?"
+        ):
+            print(
+                f"✅ Filtered file {filtered_file} already exists. Skipping download and filtering."
+            )
+            return filtered_file
+        else:
+            print(
+                f"ℹ️ Filtered file {filtered_file} already exists. Proceeding with overwrite as confirmed by user."
+            )
+
+    print(f"🌍🚰 Streaming {country.name} OSM file into the waterway filter...")
+    osmium = subprocess.Popen(
+        [
+            "osmium",
+            "tags-filter",
+            "--input-format=pbf",
+            "-",
+            "w/waterway",
+            "r/type=waterway",
+            "-o",
+            filtered_file,
+            "--overwrite",
+        ],
+        stdin=subprocess.PIPE,
+    )
+
+    # osmium starts filtering as soon as the first chunk arrives, so the
+    # download and the filter run side by side instead of one after another
+    try:
+        with SESSION.get(GEOFABRIK_URLS[country], stream=True, timeout=60) as response:
+            response.raise_for_status()
+            content_length = response.headers.get("Content-Length")
+            with progress_bar(
+                total=int(content_length) if content_length else None,
+                desc="Downloading",
+                unit="B",
+                unit_scale=True,
+            ) as pbar:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    osmium.stdin.write(chunk)
+                    pbar.update(len(chunk))
+    except BrokenPipeError:
+        # osmium exited early, its return code tells us why
+        pass
+    finally:
+        try:
+            osmium.stdin.close()
+        except BrokenPipeError:
+            pass
+        osmium.wait()
+
+    if osmium.returncode != 0:
+        raise subprocess.CalledProcessError(osmium.returncode, osmium.args)
+
+    print("✅ Download and filtering complete.")
+    return filtered_file
+
+
+def convert_to_geoparquet(country: Country, filtered_file, output_dir=PARQUET_DIR):
+    """Convert the filtered OSM file to GeoParquet using ohsome-planet."""
+    # Country-specific subdirectory, only created once we know it's new or
+    # may be overwritten so that the existence check below means something
+    geoparquet_dir = Path(output_dir) / country.value
+    jar_path = OHSOME_PLANET_JAR
 
-    if not os.path.exists(jar_path):
+    if not jar_path.exists():
         raise FileNotFoundError(
             f"❌ The JAR file {jar_path} is missing. Please build the ohsome-planet tool as described in its README."
         )
 
-    if os.path.exists(geoparquet_dir):
-        if not click.confirm(
-            f"⚠️ GeoParquet directory {geoparquet_dir} already exists. Do you want to overwrite it?",
-            default=False,
+    if geoparquet_dir.exists():
+        if not confirm(
+            f"⚠️ GeoParquet directory {geoparquet_dir} already exists. Do you want to overwrite it?"
         ):
             print(
                 f"✅ GeoParquet directory {geoparquet_dir} already exists. Skipping conversion."
@@ -199,45 +624,40 @@ def convert_to_geoparquet(country: Country, filtered_file, output_dir="data/parq
                 f"ℹ️ GeoParquet directory {geoparquet_dir} already exists. Proceeding with overwrite as confirmed by user."
             )
 
+    ensure_dir(geoparquet_dir)
     print(f"📦 Converting {country.name} waterways to GeoParquet format...")
-    with tqdm(total=100, desc="Converting", unit="%") as pbar:
-        subprocess.run(
-            [
-                "java",
-                "-jar",
-                jar_path,
-                "contributions",
-                "--pbf",
-                filtered_file,
-                "--output",
-                geoparquet_dir,
-                "--overwrite",
-            ],
-            check=True,
-        )
-        pbar.update(100)
+    # ohsome-planet reports its own progress, so no progress bar here
+    subprocess.run(
+        [
+            "java",
+            "-jar",
+            jar_path,
+            "contributions",
+            "--pbf",
+            filtered_file,
+            "--output",
+            geoparquet_dir,
+            "--overwrite",
+        ],
+        check=True,
+    )
 
     print("✅ Conversion complete.")
     return geoparquet_dir
 
 
-def run_dbt(country: Country):
-    """Run dbt to process waterways data"""
-    # Get the absolute path to the quelle directory
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    quelle_dir = os.path.join(current_dir, "quelle")
-
-    if not os.path.exists(quelle_dir):
-        print(f"❌ Could not find quelle directory at {quelle_dir}")
+def run_dbt(countries: list[Country]):
+    """Run dbt to process waterways data of all given countries"""
+    if not QUELLE_DIR.exists():
+        print(f"❌ Could not find quelle directory at {QUELLE_DIR}")
         return
 
     # Check if local duckdb database exists
-    db_path = os.path.join(current_dir, "data", "pond.duckdb")
+    db_path = DB_PATH
 
-    if os.path.exists(db_path):
-        if not click.confirm(
-            f"⚠️ Processed data {db_path} already exists. Do you want to regenerate it?",
-            default=False,
+    if db_path.exists():
+        if not confirm(
+            f"⚠️ Processed data {db_path} already exists. Do you want to regenerate it?"
         ):
             print(f"✅ Processed data {db_path} already exists. Skipping dbt.")
             return
@@ -246,46 +666,49 @@ def run_dbt(country: Country):
                 f"ℹ️ Processed data {db_path} already exists. Proceeding with regeneration as confirmed by user."
             )
 
-    print(f"🧮 Running dbt to transform {country.name} waterways data...")
-
-    # Save current directory to return to it later
-    original_dir = os.getcwd()
+    country_names = ", ".join(country.name for country in countries)
+    print(f"🧮 Running dbt to transform {country_names} waterways data...")
 
     try:
-        # Change to the quelle directory
-        os.chdir(quelle_dir)
-
         # Run dbt build to execute the model and tests
-        with tqdm(total=100, desc="Running dbt", unit="%") as pbar:
-            # Pass country as a variable to dbt
-            process = subprocess.run(
-                ["dbt", "build", "--vars", f"{{country: {country.value}}}", "--debug"],
-                check=True,
+        with progress_bar(desc="Running dbt", unit="node") as pbar:
+            # Pass the countries as a comma separated variable to dbt
+            country_var = ",".join(country.value for country in countries)
+            process = subprocess.Popen(
+                ["dbt", "build", "--vars", f"{{country: '{country_var}'}}", "--debug"],
+                cwd=QUELLE_DIR,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
             )
 
-            for line in process.stdout.splitlines():
-                print(f"  dbt: {line}")
+            def on_line(line):
+                if not line.strip():
+                    return
+                pbar.write(f"  dbt: {line}")
 
-            pbar.update(100)
+                # Advance once per finished node, the total comes from dbt
+                match = DBT_PROGRESS_RE.search(line)
+                if match and match.group(3) != "START":
+                    pbar.total = int(match.group(2))
+                    pbar.update(1)
+
+            stream_output(process, on_line)
+            process.wait()
+
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
 
         print("✅ dbt execution complete.")
 
-        if os.path.exists(db_path):
+        if db_path.exists():
             print("🐣 A Fresh db was born...")
         else:
             print(f"⚠️ Expected duckdb file not found at {db_path}")
 
     except subprocess.CalledProcessError as e:
         print(f"❌ Error running dbt: {e}")
-        print(e.stdout)
     except Exception as e:
         print(f"❌ Unexpected error running dbt: {e}")
-    finally:
-        # Return to the original directory
-        os.chdir(original_dir)
 
 
 def check_osmium_installed():
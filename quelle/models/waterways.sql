@@ -3,6 +3,9 @@
 -- Parquet file, there is a post-hook that creates a geospatial index to speed up
 -- spatial queries.
 -- ref: https://duckdb.org/docs/stable/extensions/spatial/r-tree_indexes.html
+--
+-- Rows are sorted along a Hilbert curve so that nearby waterways end up in the
+-- same row groups, and an index scan for a route reads only a few of them.
 {{
     config(
         materialized="table",
@@ -22,7 +25,13 @@ with
             tags['waterway'] as waterway_type
         from {{ source("osm", "waterways") }}
         where tags['name'] is not null
+    ),
+
+    extent as (
+        select st_extent(st_extent_agg(geom)) as bounds from waterway_features
     )
 
-select *
+select waterway_features.*
 from waterway_features
+cross join extent
+order by st_hilbert(waterway_features.geom, extent.bounds)
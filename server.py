@@ -1,113 +1,487 @@
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, File, Query, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+import asyncio
 import duckdb
-import json
+import hashlib
+import threading
 import time
 import uvicorn
-import io
+import os
+import queue
+import struct
 import lxml.etree as lxml_ET
+import numpy as np
+import orjson
+from array import array
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Warm up DuckDB before the server accepts requests"""
+    warm_up()
+    yield
+
 
 app = FastAPI(
     title="Waterway Intersection API",
     description="Optimized service to find waterways intersecting a GPX route",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 DB_PATH = "data/pond.duckdb"
+# Track and route points in any namespace, so GPX 1.0 and 1.1 both match
+GPX_POINT_TAGS = ("trkpt", "rtept")
+GPX_POINT_NAMESPACED_TAGS = tuple(f"}}{tag}" for tag in GPX_POINT_TAGS)
+
+# Extensions are only loaded from disk, never fetched over the network at
+# startup. Point DUCKDB_EXTENSION_DIR at a directory with spatial preinstalled
+# (e.g. baked into an image); by default DuckDB's own directory is used.
+DUCKDB_CONFIG: dict[str, str | bool | int | float | list[str]] = {
+    "autoinstall_known_extensions": False,
+    "autoload_known_extensions": False,
+}
+if os.environ.get("DUCKDB_EXTENSION_DIR"):
+    DUCKDB_CONFIG["extension_directory"] = os.environ["DUCKDB_EXTENSION_DIR"]
 
 # Reuse connection for better performance
-conn = duckdb.connect(DB_PATH, read_only=True)
+conn = duckdb.connect(DB_PATH, read_only=True, config=DUCKDB_CONFIG)
 conn.execute("LOAD spatial;")
 
+# Cursors share the connection's database and loaded extensions but can run
+# queries concurrently. A fixed pool of them also caps the number of queries
+# in flight, as each query already runs on several of DuckDB's threads.
+CURSOR_POOL_SIZE = os.cpu_count() or 4
+cursor_pool: queue.Queue[duckdb.DuckDBPyConnection] = queue.Queue()
+for _ in range(CURSOR_POOL_SIZE):
+    cursor_pool.put(conn.cursor())
 
-def custom_parse_gpx(gpx_content):
-    """Custom fast GPX parser using ElementTree with optimizations"""
-    start_time = time.time()
-
-    # Parse with lxml's faster parser
-    parser = lxml_ET.XMLParser(remove_blank_text=True, recover=True)
-    root = lxml_ET.parse(io.BytesIO(gpx_content), parser).getroot()
-    # Define namespace for GPX 1.1
-    ns = {"gpx": "http://www.topografix.com/GPX/1/1"}
-    # Fast path using XPath directly
-    points = [
-        (float(pt.get("lon", 0)), float(pt.get("lat", 0)))
-        for pt in root.xpath(".//gpx:trkpt", namespaces=ns)
-        if pt.get("lat") and pt.get("lon")
-    ]
+# Defaults for the returned intersection geometries: ~1 m simplification
+# tolerance and 6 decimal places (~10 cm), plenty for display on a map
+SIMPLIFY_TOLERANCE = 0.00001
+COORDINATE_PRECISION = 6
 
-    parse_time = time.time() - start_time
-    return points, parse_time
+# Douglas-Peucker tolerance in degrees (~1 m) applied to the route before
+# intersecting. Recorded tracks often have a point per second, mostly on a
+# straight line, and the cost of the intersection grows with every segment.
+ROUTE_TOLERANCE = 0.00001
 
+# With WW_TIMING=1 each response reports how long its processing steps took
+# in processing_times_ms. Off by default to keep the clock calls and the
+# extra field out of regular requests.
+DEBUG_TIMING = os.environ.get("WW_TIMING") == "1"
 
-@app.post("/process_gpx")
-async def process_gpx(file: UploadFile = File(...)):
-    """Process GPX file and find waterway intersections"""
-    t0 = time.time()
-    # Read the uploaded GPX file
-    contents = await file.read()
-    t1 = time.time()
-    print(f"File read time: {t1 - t0:.2f} seconds")
+# Responses for recently processed GPX files, keyed by a hash of the upload
+# and the query parameters
+CACHE_SIZE = 512
+response_cache: OrderedDict[tuple[bytes, float, int, bool, float], dict[str, list]] = (
+    OrderedDict()
+)
+response_cache_lock = threading.Lock()
 
-    # Use the custom parser
-    points, parse_time = custom_parse_gpx(contents)
-    t2 = time.time()
-    print(f"Custom GPX parsing time: {t2 - t1:.2f} seconds")
 
-    if len(points) < 2:
-        return {"error": "GPX file must contain at least 2 points"}
+# Long routes are queried in chunks of this many segments. The R-Tree index
+# finds candidates by the route's bounding box, and a long route's box covers
+# far more waterways than it crosses, each of which then needs an exact test.
+# The boxes of short chunks follow the route closely.
+ROUTE_CHUNK_SIZE = 2048
 
-    # Create linestring
-    linestring = f"LINESTRING({', '.join([f'{x} {y}' for x, y in points])})"
-    t3 = time.time()
-    print(f"GPX to LineString conversion time: {t3 - t2:.2f} seconds")
+# Built queries are kept for this many (chunk count, geometry) combinations.
+# The chunk count follows the uploaded route, so the cache must be bounded.
+QUERY_CACHE_SIZE = 64
 
-    # Query waterways intersecting the route
-    query = """
-        WITH route AS (
-            SELECT ST_GeomFromText($1) AS geom,
-                   ST_Envelope(ST_GeomFromText($1)) AS bbox
-        )
+# Waterways crossed by one chunk of the route, bound as WKB in $route_{i} and
+# simplified with tolerance $route_tolerance first. The chunk is a constant
+# rather than a joined relation, which lets DuckDB answer this with an R-Tree
+# index scan over its bounding box. Don't add a separate envelope predicate:
+# with two spatial predicates DuckDB falls back to a full table scan. Numeric
+# predicates on stored bounding box columns keep the index scan, but they only
+# repeat the bounding box test it already made and slow the query down.
+#
+# This is deliberately not a PREPAREd statement: EXECUTE can't take bound
+# parameters from Python, and inlining the WKB as a literal costs more to
+# parse than planning saves. Planning also needs the route as a constant to
+# choose the R-Tree index scan.
+#
+# Concurrent requests aren't coalesced into one query either. Joining the
+# waterways against a VALUES list of routes gives a SPATIAL_JOIN that scans
+# every waterway, and a UNION ALL branch per request takes as long as running
+# the requests' queries one by one. The time goes into the intersections, not
+# into per query overhead.
+CROSSINGS_CHUNK_TEMPLATE = """
         SELECT
             w.id,
             w.waterway_name,
             w.waterway_type,
-            ST_AsGeoJSON(ST_Intersection(w.geom, r.geom)) AS intersection_geojson
-        FROM waterways w, route r
-        WHERE ST_Intersects(w.geom, r.bbox)  -- First filter with bounding box (uses R-Tree)
-          AND ST_Intersects(w.geom, r.geom)  -- Then precise intersection
-        ORDER BY ST_Length(ST_Intersection(w.geom, r.geom)) DESC  -- Sort by intersection length
+            ST_Intersection(  -- Computed once per row
+                w.geom, ST_Simplify(ST_GeomFromWKB($route_{i}), $route_tolerance)
+            ) AS intersection
+        FROM waterways w
+        WHERE ST_Intersects(
+            w.geom, ST_Simplify(ST_GeomFromWKB($route_{i}), $route_tolerance)
+        )"""
+
+# A waterway crossed by several chunks has its pieces of intersection merged
+CROSSINGS_MERGE_TEMPLATE = """
+        SELECT
+            id,
+            any_value(waterway_name) AS waterway_name,
+            any_value(waterway_type) AS waterway_type,
+            ST_Union_Agg(intersection) AS intersection
+        FROM ({chunks})
+        GROUP BY id"""
+
+# With include_geometry the returned intersections are simplified with
+# tolerance $tolerance and snapped to a grid of size $grid_size, where 0
+# leaves them untouched
+CROSSINGS_TEMPLATE = """
+    WITH crossings AS ({crossings})
+    SELECT
+        id,
+        waterway_name,
+        waterway_type{geometry_column}
+    FROM crossings
+    ORDER BY ST_Length(intersection) DESC  -- Sort by full intersection length
+"""
+GEOMETRY_COLUMN = """,
+        ST_AsGeoJSON(
+            ST_ReducePrecision(
+                ST_SimplifyPreserveTopology(intersection, $tolerance), $grid_size
+            )
+        ) AS intersection_geojson"""
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def crossings_query(chunk_count, include_geometry=True):
+    """Build the query for a route split into chunk_count chunks"""
+    chunks = "\n        UNION ALL".join(
+        CROSSINGS_CHUNK_TEMPLATE.format(i=i) for i in range(chunk_count)
+    )
+    if chunk_count > 1:
+        chunks = CROSSINGS_MERGE_TEMPLATE.format(chunks=chunks)
+    return CROSSINGS_TEMPLATE.format(
+        crossings=chunks,
+        geometry_column=GEOMETRY_COLUMN if include_geometry else "",
+    )
+
+
+@contextmanager
+def pooled_cursor():
+    """Borrow a cursor from the pool, waiting if all are in use"""
+    cursor = cursor_pool.get()
+    try:
+        yield cursor
+    finally:
+        cursor_pool.put(cursor)
+
+
+class GpxPointCollector:
+    """lxml parser target collecting the coordinates of track and route points
+
+    lxml calls start for every opening tag straight from the parser, without
+    building an element tree, and close at the end of the document.
+    """
+
+    def __init__(self):
+        # One interleaved buffer, the same layout WKB and WKT use, so neither
+        # has to stitch separate longitude and latitude arrays back together
+        self.coords = array("d")
+
+    def start(self, tag, attrib):
+        if tag.endswith(GPX_POINT_NAMESPACED_TAGS) or tag in GPX_POINT_TAGS:
+            lon = attrib.get("lon")
+            lat = attrib.get("lat")
+            if lat and lon:
+                # Both are parsed before appending, so a malformed point is
+                # skipped like a missing one instead of misaligning the pairs
+                try:
+                    point = (float(lon), float(lat))
+                except ValueError:
+                    return
+                self.coords.extend(point)
+
+    def close(self):
+        return np.frombuffer(self.coords).reshape(-1, 2)
+
+
+def custom_parse_gpx(gpx_file):
+    """Custom fast GPX parser collecting track and route points with lxml
+
+    Reads from a binary file object, so an upload can be parsed straight from
+    its spooled file. Returns the points as an (n, 2) NumPy array of longitude
+    and latitude pairs.
+    """
+    # With a parser target no elements are created, so memory stays flat for
+    # long tracks and there is no per point Python work besides the callback
+    parser = lxml_ET.XMLParser(target=GpxPointCollector(), recover=True)
+    return lxml_ET.parse(gpx_file, parser)
+
+
+def to_wkb_linestring(points):
+    """Build a little-endian WKB LINESTRING from an (n, 2) coordinate array"""
+    header = struct.pack("<BII", 1, 2, len(points))  # Byte order, type, points
+    return header + np.ascontiguousarray(points, dtype="<f8").tobytes()
+
+
+def to_wkt_linestring(points):
+    """Build a WKT LINESTRING from an (n, 2) array, used in error responses"""
+    # Format all coordinates with one % call against a template joined from a
+    # preallocated list, instead of formatting and collecting a string per point
+    coords = ",".join(["%r %r"] * len(points)) % tuple(points.ravel().tolist())
+    return f"LINESTRING({coords})"
+
+
+def find_crossings(
+    gpx_file,
+    tolerance=SIMPLIFY_TOLERANCE,
+    precision=COORDINATE_PRECISION,
+    include_geometry=True,
+    route_tolerance=ROUTE_TOLERANCE,
+    use_cache=True,
+):
+    """Return the waterways crossed by a GPX route, reusing cached responses
+
+    Returns the response and whether it came from the cache. Without
+    use_cache the route is always processed and its response isn't stored.
+    """
+    if not use_cache:
+        response = compute_crossings(
+            gpx_file, tolerance, precision, include_geometry, route_tolerance
+        )
+        return response, False
+
+    # Hash the file in chunks rather than reading it into memory first
+    digest = hashlib.file_digest(
+        gpx_file, lambda: hashlib.blake2b(digest_size=16)
+    ).digest()
+    gpx_file.seek(0)
+    key = (digest, tolerance, precision, include_geometry, route_tolerance)
+    with response_cache_lock:
+        if key in response_cache:
+            response_cache.move_to_end(key)
+            return response_cache[key], True
+
+    response = compute_crossings(
+        gpx_file, tolerance, precision, include_geometry, route_tolerance
+    )
+
+    # Only successful results are cached, failed queries may be transient.
+    # Timings are left out, a cache hit doesn't repeat the work they measured.
+    if "crossings" in response:
+        with response_cache_lock:
+            response_cache[key] = {"crossings": response["crossings"]}
+            if len(response_cache) > CACHE_SIZE:
+                response_cache.popitem(last=False)
+    return response, False
+
+
+def compute_crossings(
+    gpx_file,
+    tolerance=SIMPLIFY_TOLERANCE,
+    precision=COORDINATE_PRECISION,
+    include_geometry=True,
+    route_tolerance=ROUTE_TOLERANCE,
+):
+    """Parse a GPX file and query the waterways crossed by the route
+
+    A negative precision returns the coordinates at full precision. Without
+    include_geometry only the crossed waterways are returned, not where the
+    route crosses them. The route is simplified by route_tolerance degrees
+    before intersecting, which only misses a waterway that comes within about
+    that distance of the route without being crossed by the simplified line.
     """
+    if DEBUG_TIMING:
+        t1 = time.perf_counter_ns()
+
+    # Use the custom parser
+    points = custom_parse_gpx(gpx_file)
+    if DEBUG_TIMING:
+        t2 = time.perf_counter_ns()
+
+    if len(points) < 2:
+        return {"error": "GPX file must contain at least 2 points"}
+
+    # WKB is the coordinates' raw bytes behind a 9 byte header, so DuckDB
+    # reads it without the parsing WKT would need. Consecutive chunks share
+    # their end point, so no segment of the route is left out.
+    params = {
+        f"route_{i}": to_wkb_linestring(points[start : start + ROUTE_CHUNK_SIZE + 1])
+        for i, start in enumerate(range(0, len(points) - 1, ROUTE_CHUNK_SIZE))
+    }
+    query = crossings_query(len(params), include_geometry)
+    params["route_tolerance"] = route_tolerance
+    if DEBUG_TIMING:
+        t3 = time.perf_counter_ns()
 
     try:
-        results = conn.execute(query, [linestring]).fetchall()
-        t4 = time.time()
-        print(f"Query execution time: {t4 - t3:.2f} seconds")
+        # Each request has a cursor to itself, unlike the shared connection it
+        # is safe to use in a worker thread
+        with pooled_cursor() as cursor:
+            if include_geometry:
+                params["tolerance"] = tolerance
+                params["grid_size"] = 10.0**-precision if precision >= 0 else 0.0
+            results = cursor.execute(query, params).fetch_arrow_table()
+        if DEBUG_TIMING:
+            t4 = time.perf_counter_ns()
 
-        # Format results
-        t5 = time.time()
-        print("Formatting results...")
         crossings = [
             {
-                "id": row[0],
-                "name": row[1] or "Unnamed waterway",
-                "type": row[2],
-                "intersection": json.loads(row[3]),
+                "id": waterway_id,
+                "name": name or "Unnamed waterway",
+                "type": waterway_type,
             }
-            for row in results
+            for waterway_id, name, waterway_type in zip(
+                results.column("id").to_pylist(),
+                results.column("waterway_name").to_pylist(),
+                results.column("waterway_type").to_pylist(),
+            )
         ]
-        t6 = time.time()
-        print(f"Result formatting time: {t6 - t5:.2f} seconds")
+        if include_geometry:
+            # The GeoJSON from DuckDB is embedded as is instead of being
+            # parsed into Python objects only to be serialized again
+            geometries = results.column("intersection_geojson").to_pylist()
+            for crossing, geojson in zip(crossings, geometries):
+                crossing["intersection"] = orjson.Fragment(geojson)
 
-        print(f"Processing time: {t6 - t0:.2f} seconds")
-
-        return {"crossings": crossings}
+        response = {"crossings": crossings}
+        if DEBUG_TIMING:
+            t5 = time.perf_counter_ns()
+            response["processing_times_ms"] = {
+                "total": (t5 - t1) / 1e6,
+                "gpx_parsing": (t2 - t1) / 1e6,
+                "linestring_conversion": (t3 - t2) / 1e6,
+                "intersection_finding": (t4 - t3) / 1e6,
+                "result_formatting": (t5 - t4) / 1e6,
+            }
+        return response
     except Exception as e:
-        return {"error": f"Query failed: {str(e)}", "linestring": linestring}
+        return {
+            "error": f"Query failed: {str(e)}",
+            "linestring": to_wkt_linestring(points),
+        }
+
+
+TOLERANCE_QUERY = Query(
+    SIMPLIFY_TOLERANCE,
+    ge=0,
+    description="Simplification tolerance in degrees, 0 disables simplification",
+)
+PRECISION_QUERY = Query(
+    COORDINATE_PRECISION,
+    ge=-1,
+    le=15,
+    description="Decimal places of the coordinates, -1 for full precision",
+)
+INCLUDE_GEOMETRY_QUERY = Query(
+    True, description="Return where the route crosses each waterway as GeoJSON"
+)
+ROUTE_TOLERANCE_QUERY = Query(
+    ROUTE_TOLERANCE,
+    ge=0,
+    description="Route simplification tolerance in degrees, 0 uses every point",
+)
+NO_CACHE_QUERY = Query(False, description="Process the upload even if it's cached")
+
+
+@app.post("/process_gpx")
+async def process_gpx(
+    file: UploadFile = File(...),
+    tolerance: float = TOLERANCE_QUERY,
+    precision: int = PRECISION_QUERY,
+    include_geometry: bool = INCLUDE_GEOMETRY_QUERY,
+    route_tolerance: float = ROUTE_TOLERANCE_QUERY,
+    no_cache: bool = NO_CACHE_QUERY,
+):
+    """Process GPX file and find waterway intersections"""
+    # The upload is parsed from its spooled file instead of being read into
+    # memory in one piece. Parsing and the query block, so they run in a
+    # worker thread to keep the event loop free for other uploads. The result
+    # is returned as a response directly, FastAPI's encoder doesn't know the
+    # orjson GeoJSON fragments.
+    result, cache_hit = await run_in_threadpool(
+        find_crossings,
+        file.file,
+        tolerance,
+        precision,
+        include_geometry,
+        route_tolerance,
+        not no_cache,
+    )
+    return ORJSONResponse(result, headers={"X-Cache": "HIT" if cache_hit else "MISS"})
+
+
+@app.post("/process_gpx_batch")
+async def process_gpx_batch(
+    files: list[UploadFile] = File(...),
+    tolerance: float = TOLERANCE_QUERY,
+    precision: int = PRECISION_QUERY,
+    include_geometry: bool = INCLUDE_GEOMETRY_QUERY,
+    route_tolerance: float = ROUTE_TOLERANCE_QUERY,
+    no_cache: bool = NO_CACHE_QUERY,
+):
+    """Process several GPX files in one request, results follow upload order"""
+    # Files are processed side by side, the cursor pool bounds the queries
+    responses = await asyncio.gather(
+        *(
+            run_in_threadpool(
+                find_crossings,
+                file.file,
+                tolerance,
+                precision,
+                include_geometry,
+                route_tolerance,
+                not no_cache,
+            )
+            for file in files
+        )
+    )
+    # A list rather than a mapping, uploads may share a file name
+    results = [
+        {"filename": file.filename, **response}
+        for file, (response, _) in zip(files, responses)
+    ]
+    cache_hits = sum(cache_hit for _, cache_hit in responses)
+    return ORJSONResponse(
+        {"results": results}, headers={"X-Cache-Hits": f"{cache_hits}/{len(files)}"}
+    )
+
+
+def probe_params():
+    """Parameters of the crossings query for a short two point route"""
+    return {
+        "route_0": to_wkb_linestring(np.array([[0.0, 0.0], [1.0, 1.0]])),
+        "route_tolerance": 0.0,
+        "tolerance": 0.0,
+        "grid_size": 0.0,
+    }
+
+
+def uses_rtree_index():
+    """Check that DuckDB plans the crossings query as an R-Tree index scan"""
+    plan = conn.execute(f"EXPLAIN {crossings_query(1)}", probe_params())
+    return any("RTREE_INDEX_SCAN" in row[1] for row in plan.fetchall())
+
+
+def warm_up():
+    """Run the crossings query once so the first request doesn't have to
+
+    The first query reads the R-Tree index and the table's metadata from disk
+    and initializes the spatial functions, which takes longer than the query.
+    """
+    with pooled_cursor() as cursor:
+        cursor.execute(crossings_query(1), probe_params()).fetchall()
 
 
 @app.get("/health")
-async def health_check():
+def health_check():
     """Health check endpoint"""
-    result = conn.execute("SELECT COUNT(*) FROM waterways").fetchone()
+    # A plain def runs in FastAPI's threadpool instead of blocking the loop
+    with pooled_cursor() as cursor:
+        result = cursor.execute("SELECT COUNT(*) FROM waterways").fetchone()
     waterway_count = result[0] if result else 0
     return {"status": "healthy", "database": DB_PATH, "waterway_count": waterway_count}
 
@@ -123,4 +497,8 @@ if __name__ == "__main__":
         exit(1)
     else:
         print(f"🌊 Loaded {waterway_count} waterways")
+    if not uses_rtree_index():
+        print(
+            "⚠️ Queries won't use the R-Tree index, every request scans all waterways."
+        )
     uvicorn.run(app, host="0.0.0.0", port=8000)